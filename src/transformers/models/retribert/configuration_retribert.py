@@ -71,6 +71,23 @@ class RetriBertConfig(PretrainedConfig):
             Whether or not to use the same Bert-type encoder for the queries and document
         projection_dim (`int`, *optional*, defaults to 128):
             Final dimension of the query and document representation after projection
+        concurrent_streams (`bool`, *optional*, defaults to `False`):
+            Whether or not to run the query and document encoders on separate CUDA streams in the forward pass. Only
+            used when `share_encoders=False` and the inputs are on a CUDA device.
+        use_gradient_checkpointing (`bool`, *optional*, defaults to `True`):
+            Whether or not to recompute the activations of each mini-batch in the backward pass when embedding
+            sentences with `checkpoint_batch_size > 0`. Setting it to `False` keeps the mini-batch encoding but stores
+            all activations, which avoids the recomputation cost for models small enough to fit in memory.
+        checkpoint_use_reentrant (`bool`, *optional*, defaults to `True`):
+            Whether or not to use the reentrant implementation of `torch.utils.checkpoint.checkpoint` when embedding
+            sentences with `checkpoint_batch_size > 0`. Setting it to `False` requires PyTorch >= 1.11.
+        checkpoint_preserve_rng_state (`bool`, *optional*, defaults to `True`):
+            Whether or not to stash and restore the RNG state around each checkpointed mini-batch. Setting it to
+            `False` saves that overhead but the dropout masks drawn during recomputation differ from the ones used in
+            the forward pass.
+        compile_partial_encode (`bool`, *optional*, defaults to `False`):
+            Whether or not to run the encoder and pooler on each checkpointed mini-batch through
+            `torch.compile(mode="reduce-overhead")`. Only used with PyTorch >= 2.0 and inputs on a CUDA device.
     """
     model_type = "retribert"
 
@@ -90,6 +107,11 @@ class RetriBertConfig(PretrainedConfig):
         layer_norm_eps=1e-12,
         share_encoders=True,
         projection_dim=128,
+        concurrent_streams=False,
+        use_gradient_checkpointing=True,
+        checkpoint_use_reentrant=True,
+        checkpoint_preserve_rng_state=True,
+        compile_partial_encode=False,
         pad_token_id=0,
         **kwargs,
     ):
@@ -109,3 +131,8 @@ class RetriBertConfig(PretrainedConfig):
         self.layer_norm_eps = layer_norm_eps
         self.share_encoders = share_encoders
         self.projection_dim = projection_dim
+        self.concurrent_streams = concurrent_streams
+        self.use_gradient_checkpointing = use_gradient_checkpointing
+        self.checkpoint_use_reentrant = checkpoint_use_reentrant
+        self.checkpoint_preserve_rng_state = checkpoint_preserve_rng_state
+        self.compile_partial_encode = compile_partial_encode
@@ -17,14 +17,14 @@ RetriBERT model
 """
 
 
-import math
-from typing import Optional
+from typing import Callable, Optional
 
 import torch
 import torch.utils.checkpoint as checkpoint
 from torch import nn
 
 from ...modeling_utils import PreTrainedModel
+from ...pytorch_utils import is_torch_greater_or_equal_than_2_0
 from ...utils import add_start_docstrings, logging
 from ..bert.modeling_bert import BertModel
 from .configuration_retribert import RetriBertConfig
@@ -38,6 +38,11 @@ RETRIBERT_PRETRAINED_MODEL_ARCHIVE_LIST = [
 ]
 
 
+def _pad_batch(tensor: torch.Tensor, num_padding: int) -> torch.Tensor:
+    # appends `num_padding` all-zero examples along the first (batch) dimension, whatever the rank of `tensor`
+    return nn.functional.pad(tensor, (0, 0) * (tensor.dim() - 1) + (0, num_padding))
+
+
 # INTERFACE FOR ENCODER AND TASK SPECIFIC MODEL #
 class RetriBertPreTrainedModel(PreTrainedModel):
     """
@@ -97,10 +102,65 @@ class RetriBertModel(RetriBertPreTrainedModel):
         self.project_doc = nn.Linear(config.hidden_size, config.projection_dim, bias=False)
 
         self.ce_loss = nn.CrossEntropyLoss(reduction="mean")
+        # both encoders share `config`, so a single all-`None` head mask covers them
+        self._head_mask = [None] * config.num_hidden_layers
+        # `torch.compile`-d version of `_partial_encode`, built on first use when `config.compile_partial_encode` is set
+        self._compiled_partial_encode = None
 
         # Initialize weights and apply final processing
         self.post_init()
 
+    def _partial_encode(
+        self, embedding_output: torch.Tensor, extended_attention_mask: torch.Tensor, sent_encoder: BertModel
+    ) -> torch.Tensor:
+        # runs the encoder and pooler of `sent_encoder` on one mini-batch of embeddings
+        encoder_outputs = sent_encoder.encoder(
+            embedding_output,
+            attention_mask=extended_attention_mask,
+            head_mask=self._head_mask,
+        )
+        sequence_output = encoder_outputs[0]
+        pooled_output = sent_encoder.pooler(sequence_output)
+        return pooled_output
+
+    def _encode_mini_batches(
+        self,
+        embedding_output: torch.Tensor,
+        extended_attention_mask: torch.Tensor,
+        sent_encoder: BertModel,
+        checkpoint_batch_size: int,
+        partial_encode: Callable,
+        pad_last_mini_batch: bool = False,
+        clone_outputs: bool = False,
+    ) -> torch.Tensor:
+        # runs `partial_encode` on `checkpoint_batch_size` examples at a time and concatenates the pooled outputs
+        num_padding = -embedding_output.shape[0] % checkpoint_batch_size if pad_last_mini_batch else 0
+        if num_padding > 0:
+            # zero rows are added along the batch dimension and their pooled outputs are dropped below
+            embedding_output = _pad_batch(embedding_output, num_padding)
+            extended_attention_mask = _pad_batch(extended_attention_mask, num_padding)
+        embedding_chunks = torch.split(embedding_output, checkpoint_batch_size, dim=0)
+        attention_mask_chunks = torch.split(extended_attention_mask, checkpoint_batch_size, dim=0)
+        checkpoint_kwargs = {"preserve_rng_state": self.config.checkpoint_preserve_rng_state}
+        if not self.config.checkpoint_use_reentrant:
+            # the `use_reentrant` argument only exists from PyTorch 1.11 on
+            checkpoint_kwargs["use_reentrant"] = False
+        pooled_output_list = []
+        for b_embedding_output, b_attention_mask in zip(embedding_chunks, attention_mask_chunks):
+            if torch.is_grad_enabled() and self.config.use_gradient_checkpointing:
+                pooled_output = checkpoint.checkpoint(
+                    partial_encode, b_embedding_output, b_attention_mask, sent_encoder, **checkpoint_kwargs
+                )
+            else:
+                # either no backward pass follows or all activations are kept, recomputation would be pure overhead
+                pooled_output = partial_encode(b_embedding_output, b_attention_mask, sent_encoder)
+            if clone_outputs:
+                pooled_output = pooled_output.clone()
+            pooled_output_list.append(pooled_output)
+        if num_padding > 0:
+            pooled_output_list[-1] = pooled_output_list[-1][: checkpoint_batch_size - num_padding]
+        return torch.cat(pooled_output_list, dim=0)
+
     def embed_sentences_checkpointed(
         self,
         input_ids,
@@ -113,37 +173,43 @@ class RetriBertModel(RetriBertPreTrainedModel):
             return sent_encoder(input_ids, attention_mask=attention_mask)[1]
         else:
             # prepare implicit variables
-            device = input_ids.device
             input_shape = input_ids.size()
-            token_type_ids = torch.zeros(input_shape, dtype=torch.long, device=device)
-            head_mask = [None] * sent_encoder.config.num_hidden_layers
-            extended_attention_mask: torch.Tensor = sent_encoder.get_extended_attention_mask(
-                attention_mask, input_shape
-            )
-
-            # define function for checkpointing
-            def partial_encode(*inputs):
-                encoder_outputs = sent_encoder.encoder(
-                    inputs[0],
-                    attention_mask=inputs[1],
-                    head_mask=head_mask,
-                )
-                sequence_output = encoder_outputs[0]
-                pooled_output = sent_encoder.pooler(sequence_output)
-                return pooled_output
 
             # run embedding layer on everything at once
             embedding_output = sent_encoder.embeddings(
-                input_ids=input_ids, position_ids=None, token_type_ids=token_type_ids, inputs_embeds=None
+                input_ids=input_ids, position_ids=None, token_type_ids=None, inputs_embeds=None
+            )
+            # build the additive mask once, directly in the dtype of the hidden states it is added to in attention
+            dtype = embedding_output.dtype
+            if attention_mask.dim() == 2 and not sent_encoder.config.is_decoder:
+                # same result as `get_extended_attention_mask` for an encoder, without its generic shape dispatch
+                extended_attention_mask = (1.0 - attention_mask[:, None, None, :].to(dtype)) * torch.finfo(dtype).min
+            else:
+                extended_attention_mask = sent_encoder.get_extended_attention_mask(
+                    attention_mask, input_shape, dtype=dtype
+                )
+            partial_encode = self._partial_encode
+            use_compiled = (
+                self.config.compile_partial_encode and is_torch_greater_or_equal_than_2_0 and input_ids.is_cuda
+            )
+            if use_compiled:
+                # every mini-batch runs the same graph, capture it once and replay it for the following ones
+                if self._compiled_partial_encode is None:
+                    self._compiled_partial_encode = torch.compile(
+                        self._partial_encode, mode="reduce-overhead", dynamic=False
+                    )
+                partial_encode = self._compiled_partial_encode
+            # pad the last mini-batch so it does not trigger a new capture, and copy the outputs out of the CUDA graph
+            # static buffers which the replay for the next mini-batch overwrites
+            return self._encode_mini_batches(
+                embedding_output,
+                extended_attention_mask,
+                sent_encoder,
+                checkpoint_batch_size,
+                partial_encode,
+                pad_last_mini_batch=use_compiled,
+                clone_outputs=use_compiled,
             )
-            # run encoding and pooling on one mini-batch at a time
-            pooled_output_list = []
-            for b in range(math.ceil(input_ids.shape[0] / checkpoint_batch_size)):
-                b_embedding_output = embedding_output[b * checkpoint_batch_size : (b + 1) * checkpoint_batch_size]
-                b_attention_mask = extended_attention_mask[b * checkpoint_batch_size : (b + 1) * checkpoint_batch_size]
-                pooled_output = checkpoint.checkpoint(partial_encode, b_embedding_output, b_attention_mask)
-                pooled_output_list.append(pooled_output)
-            return torch.cat(pooled_output_list, dim=0)
 
     def embed_questions(
         self,
@@ -173,6 +239,17 @@ class RetriBertModel(RetriBertPreTrainedModel):
         )
         return self.project_doc(a_reps)
 
+    def quantize_for_inference(self) -> "RetriBertModel":
+        """
+        Returns a copy of the model where all `nn.Linear` layers (in both BERT encoders and the query and document
+        projections) are dynamically quantized to int8 with `torch.quantization.quantize_dynamic`. The original model
+        is left untouched.
+
+        Dynamically quantized layers only run on CPU, so this is meant for CPU inference (e.g. embedding a corpus with
+        [`~RetriBertModel.embed_answers`]) and not for training.
+        """
+        return torch.quantization.quantize_dynamic(self, {nn.Linear}, dtype=torch.qint8)
+
     def forward(
         self,
         input_ids_query: torch.LongTensor,
@@ -204,17 +281,38 @@ class RetriBertModel(RetriBertPreTrainedModel):
             checkpoint_batch_size (`int`, *optional*, defaults to `-1`):
                 If greater than 0, uses gradient checkpointing to only compute sequence representation on
                 `checkpoint_batch_size` examples at a time on the GPU. All query representations are still compared to
-                all document representations in the batch.
+                all document representations in the batch. Set `config.use_gradient_checkpointing=False` to keep the
+                mini-batches without recomputing their activations in the backward pass.
 
         Return:
             `torch.FloatTensor``: The bidirectional cross-entropy loss obtained while trying to match each query to its
             corresponding document and each document to its corresponding query in the batch
         """
         device = input_ids_query.device
-        q_reps = self.embed_questions(input_ids_query, attention_mask_query, checkpoint_batch_size)
-        a_reps = self.embed_answers(input_ids_doc, attention_mask_doc, checkpoint_batch_size)
-        compare_scores = torch.mm(q_reps, a_reps.t())
-        loss_qa = self.ce_loss(compare_scores, torch.arange(compare_scores.shape[1]).to(device))
-        loss_aq = self.ce_loss(compare_scores.t(), torch.arange(compare_scores.shape[0]).to(device))
+        if self.config.concurrent_streams and self.bert_doc is not None and input_ids_query.is_cuda:
+            # the two encoders are independent until the scores are computed, overlap them on separate streams
+            current_stream = torch.cuda.current_stream(device)
+            stream_query = torch.cuda.Stream(device)
+            stream_doc = torch.cuda.Stream(device)
+            stream_query.wait_stream(current_stream)
+            stream_doc.wait_stream(current_stream)
+            with torch.cuda.stream(stream_query):
+                q_reps = self.embed_questions(input_ids_query, attention_mask_query, checkpoint_batch_size)
+            with torch.cuda.stream(stream_doc):
+                a_reps = self.embed_answers(input_ids_doc, attention_mask_doc, checkpoint_batch_size)
+            current_stream.wait_stream(stream_query)
+            current_stream.wait_stream(stream_doc)
+            q_reps.record_stream(current_stream)
+            a_reps.record_stream(current_stream)
+        else:
+            q_reps = self.embed_questions(input_ids_query, attention_mask_query, checkpoint_batch_size)
+            a_reps = self.embed_answers(input_ids_doc, attention_mask_doc, checkpoint_batch_size)
+        # runs as a reduced-precision GEMM when called under `torch.autocast`, the loss below is still computed in fp32
+        compare_scores = torch.matmul(q_reps, a_reps.transpose(0, 1)).float()
+        # the target of each query (resp. document) is the diagonal entry of its row (resp. column), so both
+        # directions of the cross-entropy reduce to a log-sum-exp over the scores minus their diagonal
+        diagonal_scores = compare_scores.diagonal()
+        loss_qa = (torch.logsumexp(compare_scores, dim=1) - diagonal_scores).mean()
+        loss_aq = (torch.logsumexp(compare_scores, dim=0) - diagonal_scores).mean()
         loss = (loss_qa + loss_aq) / 2
         return loss
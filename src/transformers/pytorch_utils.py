@@ -29,6 +29,7 @@ parsed_torch_version_base = version.parse(version.parse(torch.__version__).base_
 
 is_torch_greater_or_equal_than_1_10 = parsed_torch_version_base >= version.parse("1.10")
 is_torch_less_than_1_11 = parsed_torch_version_base < version.parse("1.11")
+is_torch_greater_or_equal_than_2_0 = parsed_torch_version_base >= version.parse("2.0")
 
 
 def softmax_backward_data(parent, grad_output, output, dim, self):
@@ -0,0 +1,242 @@
+# coding=utf-8
+# Copyright 2023 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Testing suite for the PyTorch RetriBERT model. """
+
+
+import unittest
+
+from transformers import RetriBertConfig, is_torch_available
+from transformers.testing_utils import require_torch, require_torch_gpu, torch_device
+
+from ...test_modeling_common import ids_tensor, random_attention_mask
+
+
+if is_torch_available():
+    import torch
+    from torch import nn
+
+    from transformers import RetriBertModel
+    from transformers.pytorch_utils import is_torch_greater_or_equal_than_2_0, is_torch_less_than_1_11
+
+    try:
+        from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+    except ImportError:
+        # PyTorch < 1.13
+        from torch.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+
+
+@require_torch
+class RetriBertModelTest(unittest.TestCase):
+    batch_size = 5
+    seq_length = 7
+    checkpoint_batch_size = 2
+
+    def get_config(self, **kwargs):
+        return RetriBertConfig(
+            vocab_size=99,
+            hidden_size=32,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            intermediate_size=37,
+            max_position_embeddings=64,
+            projection_dim=16,
+            **kwargs,
+        )
+
+    def prepare_inputs(self, vocab_size):
+        input_ids_query = ids_tensor([self.batch_size, self.seq_length], vocab_size)
+        attention_mask_query = random_attention_mask([self.batch_size, self.seq_length])
+        input_ids_doc = ids_tensor([self.batch_size, self.seq_length], vocab_size)
+        attention_mask_doc = random_attention_mask([self.batch_size, self.seq_length])
+        return input_ids_query, attention_mask_query, input_ids_doc, attention_mask_doc
+
+    def test_loss_matches_bidirectional_cross_entropy(self):
+        for share_encoders in [True, False]:
+            with self.subTest(share_encoders=share_encoders):
+                config = self.get_config(share_encoders=share_encoders)
+                # eval mode disables dropout so both computations see the same representations
+                model = RetriBertModel(config).to(torch_device).eval()
+                input_ids_query, attention_mask_query, input_ids_doc, attention_mask_doc = self.prepare_inputs(
+                    config.vocab_size
+                )
+
+                with torch.no_grad():
+                    loss = model(input_ids_query, attention_mask_query, input_ids_doc, attention_mask_doc)
+                    q_reps = model.embed_questions(input_ids_query, attention_mask_query)
+                    a_reps = model.embed_answers(input_ids_doc, attention_mask_doc)
+
+                compare_scores = torch.mm(q_reps, a_reps.t())
+                targets = torch.arange(self.batch_size, device=torch_device)
+                ce_loss = nn.CrossEntropyLoss(reduction="mean")
+                expected_loss = (ce_loss(compare_scores, targets) + ce_loss(compare_scores.t(), targets)) / 2
+
+                self.assertTrue(torch.allclose(loss, expected_loss, atol=1e-5))
+
+    def embed_and_backward(self, model, input_ids, attention_mask, checkpoint_batch_size):
+        model.zero_grad()
+        q_reps = model.embed_questions(input_ids, attention_mask, checkpoint_batch_size)
+        q_reps.sum().backward()
+        grads = {name: param.grad.clone() for name, param in model.named_parameters() if param.grad is not None}
+        return q_reps.detach(), grads
+
+    def assert_grads_close(self, grads, expected_grads, atol=1e-5):
+        self.assertEqual(grads.keys(), expected_grads.keys())
+        for name, grad in grads.items():
+            self.assertTrue(torch.allclose(grad, expected_grads[name], atol=atol), msg=name)
+
+    def test_checkpointed_embeddings_match_full_batch(self):
+        config = self.get_config()
+        model = RetriBertModel(config).to(torch_device).eval()
+        input_ids, attention_mask, _, _ = self.prepare_inputs(config.vocab_size)
+
+        expected_reps, expected_grads = self.embed_and_backward(model, input_ids, attention_mask, -1)
+
+        # (use_gradient_checkpointing, checkpoint_use_reentrant, checkpoint_preserve_rng_state)
+        checkpoint_configs = [(True, True, True), (False, True, True), (True, True, False)]
+        if not is_torch_less_than_1_11:
+            checkpoint_configs += [(True, False, True), (True, False, False)]
+
+        for use_gradient_checkpointing, checkpoint_use_reentrant, checkpoint_preserve_rng_state in checkpoint_configs:
+            with self.subTest(
+                use_gradient_checkpointing=use_gradient_checkpointing,
+                checkpoint_use_reentrant=checkpoint_use_reentrant,
+                checkpoint_preserve_rng_state=checkpoint_preserve_rng_state,
+            ):
+                model.config.use_gradient_checkpointing = use_gradient_checkpointing
+                model.config.checkpoint_use_reentrant = checkpoint_use_reentrant
+                model.config.checkpoint_preserve_rng_state = checkpoint_preserve_rng_state
+                reps, grads = self.embed_and_backward(model, input_ids, attention_mask, self.checkpoint_batch_size)
+
+                self.assertTrue(torch.allclose(reps, expected_reps, atol=1e-5))
+                self.assert_grads_close(grads, expected_grads)
+
+    def test_padded_mini_batches_match_unpadded(self):
+        # the last mini-batch is incomplete, so padding it adds examples that must be dropped again
+        self.assertNotEqual(self.batch_size % self.checkpoint_batch_size, 0)
+
+        for is_decoder in [False, True]:
+            with self.subTest(is_decoder=is_decoder):
+                config = self.get_config(is_decoder=is_decoder)
+                model = RetriBertModel(config).to(torch_device).eval()
+                sent_encoder = model.bert_query
+                input_ids, attention_mask, _, _ = self.prepare_inputs(config.vocab_size)
+
+                results = []
+                for pad_last_mini_batch in [False, True]:
+                    model.zero_grad()
+                    embedding_output = sent_encoder.embeddings(input_ids=input_ids)
+                    extended_attention_mask = sent_encoder.get_extended_attention_mask(attention_mask, input_ids.shape)
+                    # decoders get a causal mask of shape (batch_size, 1, seq_length, seq_length)
+                    self.assertEqual(extended_attention_mask.shape[2], self.seq_length if is_decoder else 1)
+                    pooled_output = model._encode_mini_batches(
+                        embedding_output,
+                        extended_attention_mask,
+                        sent_encoder,
+                        self.checkpoint_batch_size,
+                        model._partial_encode,
+                        pad_last_mini_batch=pad_last_mini_batch,
+                        clone_outputs=pad_last_mini_batch,
+                    )
+                    pooled_output.sum().backward()
+                    grads = {
+                        name: param.grad.clone() for name, param in model.named_parameters() if param.grad is not None
+                    }
+                    results.append((pooled_output.detach(), grads))
+
+                (expected_output, expected_grads), (output, grads) = results
+                self.assertEqual(output.shape, (self.batch_size, config.hidden_size))
+                self.assertTrue(torch.allclose(output, expected_output, atol=1e-5))
+                self.assert_grads_close(grads, expected_grads)
+
+    def test_quantize_for_inference(self):
+        if not {"fbgemm", "qnnpack"} & set(torch.backends.quantized.supported_engines):
+            self.skipTest("No quantized engine available")
+
+        config = self.get_config(share_encoders=False)
+        model = RetriBertModel(config).eval()
+        input_ids_query, attention_mask_query, input_ids_doc, attention_mask_doc = (
+            tensor.cpu() for tensor in self.prepare_inputs(config.vocab_size)
+        )
+        num_linear_layers = sum(isinstance(module, nn.Linear) for module in model.modules())
+        state_dict = {name: param.clone() for name, param in model.state_dict().items()}
+
+        quantized_model = model.quantize_for_inference()
+
+        # every linear layer of the copy is replaced by its dynamically quantized counterpart
+        self.assertIsNot(quantized_model, model)
+        self.assertFalse(any(isinstance(module, nn.Linear) for module in quantized_model.modules()))
+        num_quantized_layers = sum(isinstance(module, DynamicQuantizedLinear) for module in quantized_model.modules())
+        self.assertEqual(num_quantized_layers, num_linear_layers)
+
+        # the original model is left untouched
+        self.assertEqual(sum(isinstance(module, nn.Linear) for module in model.modules()), num_linear_layers)
+        for name, param in model.state_dict().items():
+            self.assertTrue(torch.equal(param, state_dict[name]), msg=name)
+
+        with torch.no_grad():
+            for embed_fn, input_ids, attention_mask in [
+                ("embed_questions", input_ids_query, attention_mask_query),
+                ("embed_answers", input_ids_doc, attention_mask_doc),
+            ]:
+                expected_reps = getattr(model, embed_fn)(input_ids, attention_mask)
+                reps = getattr(quantized_model, embed_fn)(input_ids, attention_mask)
+                self.assertTrue(torch.allclose(reps, expected_reps, atol=1e-2), msg=embed_fn)
+
+    @require_torch_gpu
+    def test_concurrent_streams_match_sequential(self):
+        config = self.get_config(share_encoders=False)
+        model = RetriBertModel(config).to(torch_device).eval()
+        inputs = self.prepare_inputs(config.vocab_size)
+
+        results = []
+        for concurrent_streams in [False, True]:
+            model.config.concurrent_streams = concurrent_streams
+            model.zero_grad()
+            loss = model(*inputs)
+            loss.backward()
+            grads = {name: param.grad.clone() for name, param in model.named_parameters() if param.grad is not None}
+            results.append((loss.detach(), grads))
+
+        (expected_loss, expected_grads), (loss, grads) = results
+        self.assertTrue(torch.allclose(loss, expected_loss, atol=1e-5))
+        self.assert_grads_close(grads, expected_grads)
+
+    @require_torch_gpu
+    def test_compiled_checkpointed_embeddings_match_eager(self):
+        if not is_torch_greater_or_equal_than_2_0:
+            self.skipTest("`torch.compile` requires PyTorch >= 2.0")
+        # the last mini-batch is incomplete, so the compiled path pads it
+        self.assertNotEqual(self.batch_size % self.checkpoint_batch_size, 0)
+
+        for is_decoder in [False, True]:
+            with self.subTest(is_decoder=is_decoder):
+                config = self.get_config(is_decoder=is_decoder)
+                model = RetriBertModel(config).to(torch_device).eval()
+                input_ids, attention_mask, _, _ = self.prepare_inputs(config.vocab_size)
+
+                with torch.no_grad():
+                    expected_reps = model.embed_questions(input_ids, attention_mask, self.checkpoint_batch_size)
+                _, expected_grads = self.embed_and_backward(
+                    model, input_ids, attention_mask, self.checkpoint_batch_size
+                )
+
+                model.config.compile_partial_encode = True
+                with torch.no_grad():
+                    reps = model.embed_questions(input_ids, attention_mask, self.checkpoint_batch_size)
+                self.assertTrue(torch.allclose(reps, expected_reps, atol=1e-4))
+
+                reps, grads = self.embed_and_backward(model, input_ids, attention_mask, self.checkpoint_batch_size)
+                self.assertTrue(torch.allclose(reps, expected_reps, atol=1e-4))
+                self.assert_grads_close(grads, expected_grads, atol=1e-4)